@@ -18,15 +18,21 @@
 import io
 import os
 import re
-import shutil
 import sqlite3
+import tempfile
+import threading
 import time
-from datetime import datetime
+from contextlib import closing, contextmanager
+from datetime import date, datetime, time as time_of_day
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import streamlit as st
+import xlsxwriter
 
 # =========================================================
 # 設定
@@ -34,6 +40,8 @@ import streamlit as st
 DB_PATH = "parts_bom.db"
 MASTER_CANDIDATES = ["parts_master.xlsx", "parts_master.csv"]
 BACKUP_DIR = Path("_db_backups")
+# 一覧表示用の列指向ミラー（parts を変更するたびに書き直す）
+PARTS_PARQUET_PATH = Path("parts.parquet")
 
 PART_COLS = [
     "partNo","description","manufacturer","category",
@@ -42,6 +50,19 @@ PART_COLS = [
     "category1","category2","pricingModel",
     "unitPricePerKWh","unitPricePerYear","refCapacityKWh",
 ]
+# 取り込み時に欠けていれば空文字で補う列（それ以外はNULL）
+TEXT_COLS = ["manufacturer","category","unit","notes","category1","category2","pricingModel"]
+REAL_COLS = ["unitPrice","unitPricePerKWh","unitPricePerYear","refCapacityKWh"]
+# Parquetミラーに持たせる列
+PARTS_MIRROR_COLS = [
+    "id","partNo","description","manufacturer","category","category1","category2",
+    "unit","unitPrice","pricingModel","unitPricePerKWh","unitPricePerYear","refCapacityKWh","notes",
+]
+# read_parts が返す列（データベースタブの一覧に出す分だけ）
+PARTS_VIEW_COLS = [
+    "id","partNo","description","category1","category2",
+    "pricingModel","unit","unitPrice","unitPricePerKWh","unitPricePerYear","notes",
+]
 
 # =========================================================
 # DBユーティリティ
@@ -83,17 +104,203 @@ CREATE_SQL = {
             FOREIGN KEY (partId) REFERENCES parts(id) ON DELETE CASCADE
         );
     """,
+    "meta": """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """,
+}
+
+# parts が変わるたびに meta.parts_version を進める（Parquetミラーの鮮度判定用）
+PARTS_VERSION_SQL = {
+    f"parts_version_{ev.lower()}": f"""
+        CREATE TRIGGER IF NOT EXISTS parts_version_{ev.lower()} AFTER {ev} ON parts BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'parts_version';
+        END
+    """
+    for ev in ("INSERT", "DELETE", "UPDATE")
+}
+
+# partNo + description（大文字小文字を区別しない）で重複登録を防ぐ
+PART_KEY_SQL = "lower(partNo), lower(IFNULL(description, ''))"
+INDEX_SQL = {
+    "ux_parts_key": f"CREATE UNIQUE INDEX IF NOT EXISTS ux_parts_key ON parts({PART_KEY_SQL})",
+    # カテゴリ1/2の絞り込み（IN）と選択肢（DISTINCT）用
+    "ix_parts_cat1": "CREATE INDEX IF NOT EXISTS ix_parts_cat1 ON parts(category1)",
+    "ix_parts_cat2": "CREATE INDEX IF NOT EXISTS ix_parts_cat2 ON parts(category2)",
+}
+
+# フリーワード検索用の全文索引（FTS5 外部コンテンツ表 + 同期トリガー）
+# trigram トークナイザで LIKE '%q%' と同じ部分一致（大文字小文字無視）を索引で引く
+FTS_COLS = ["partNo","description","manufacturer","category","category1","category2","unit","notes"]
+FTS_MIN_QUERY_LEN = 3  # trigram は3文字未満の語を検索できない
+SEARCH_MIN_QUERY_LEN = 2  # これより短いフリーワードは絞り込みなし扱い（1文字ではほぼ全件に一致するため）
+_fts_cols = ", ".join(FTS_COLS)
+_fts_new = ", ".join(f"new.{c}" for c in FTS_COLS)
+_fts_old = ", ".join(f"old.{c}" for c in FTS_COLS)
+FTS_SQL = {
+    "parts_fts": f"""
+        CREATE VIRTUAL TABLE parts_fts USING fts5(
+            {_fts_cols}, content='parts', content_rowid='id', tokenize='trigram'
+        )
+    """,
+    "parts_fts_ai": f"""
+        CREATE TRIGGER IF NOT EXISTS parts_fts_ai AFTER INSERT ON parts BEGIN
+            INSERT INTO parts_fts(rowid, {_fts_cols}) VALUES (new.id, {_fts_new});
+        END
+    """,
+    "parts_fts_ad": f"""
+        CREATE TRIGGER IF NOT EXISTS parts_fts_ad AFTER DELETE ON parts BEGIN
+            INSERT INTO parts_fts(parts_fts, rowid, {_fts_cols}) VALUES ('delete', old.id, {_fts_old});
+        END
+    """,
+    "parts_fts_au": f"""
+        CREATE TRIGGER IF NOT EXISTS parts_fts_au AFTER UPDATE ON parts BEGIN
+            INSERT INTO parts_fts(parts_fts, rowid, {_fts_cols}) VALUES ('delete', old.id, {_fts_old});
+            INSERT INTO parts_fts(rowid, {_fts_cols}) VALUES (new.id, {_fts_new});
+        END
+    """,
 }
 
-def get_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+@st.cache_resource
+def _db() -> Tuple[sqlite3.Connection, threading.RLock]:
+    # Streamlitは操作のたびにスクリプト全体を再実行するため、接続は1本をプロセス内で使い回す
+    # isolation_level=None（自動コミット）とし、複数文の書き込みは transaction() で囲む
+    # 接続は全セッション（スレッド）で共有するため、使うときは必ずロックを取る（locked_conn）
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-65536")
+    return con, threading.RLock()
+
+@contextmanager
+def locked_conn():
+    con, lock = _db()
+    with lock:
+        yield con
+
+@contextmanager
+def transaction():
+    with locked_conn() as con:
+        con.execute("BEGIN")
+        try:
+            yield con
+            con.execute("COMMIT")
+        finally:
+            # 例外（BaseException含む）やCOMMIT失敗で開いたままなら戻す。共有接続なので残すと全セッションが詰まる
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+
+def _count_duplicate_parts(con: sqlite3.Connection) -> int:
+    sql = f"SELECT IFNULL(SUM(n - 1), 0) FROM (SELECT COUNT(*) AS n FROM parts GROUP BY {PART_KEY_SQL})"
+    (n,) = con.execute(sql).fetchone()
+    return int(n)
+
+def _merge_duplicate_parts(con: sqlite3.Connection) -> int:
+    # 旧バージョンで作られたDBには重複行が残っている場合がある
+    # BOM明細は最小IDの行へ付け替えてから、残りを削除する。削除した行数を返す
+    con.execute("""
+        UPDATE bom_items SET partId = (
+            SELECT MIN(p2.id) FROM parts p1
+            JOIN parts p2 ON lower(p2.partNo) = lower(p1.partNo)
+                         AND lower(IFNULL(p2.description, '')) = lower(IFNULL(p1.description, ''))
+            WHERE p1.id = bom_items.partId
+        )
+        WHERE partId IN (SELECT id FROM parts)
+    """)
+    cur = con.execute(f"DELETE FROM parts WHERE id NOT IN (SELECT MIN(id) FROM parts GROUP BY {PART_KEY_SQL})")
+    return cur.rowcount
+
+@st.cache_resource
+def init_db() -> Tuple[int, Optional[Path]]:
+    # スキーマ整備とミラー確認はプロセスごとに1回だけ（以降の鮮度確認は read_parts 側）
+    # 戻り値：(重複統合で削除したパーツ行数, 統合前に取ったバックアップ)
+    merged, backup = 0, None
+    with locked_conn():
+        with transaction() as con:
+            for sql in CREATE_SQL.values():
+                con.execute(sql)
+            needs_merge = not has_index(con, "ux_parts_key") and _count_duplicate_parts(con) > 0
+        if needs_merge:
+            # 統合はデータ削除を伴うため、他のDB更新と同じく先にバックアップする
+            backup = backup_db_file()
+        with transaction() as con:
+            for sql in INDEX_SQL.values():
+                try:
+                    con.execute(sql)
+                except sqlite3.IntegrityError:
+                    # ux_parts_key 作成時、既存データに重複がある場合のみ
+                    merged = _merge_duplicate_parts(con)
+                    con.execute(sql)
+            con.execute("INSERT OR IGNORE INTO meta(key, value) VALUES ('parts_version', 0)")
+            for sql in PARTS_VERSION_SQL.values():
+                con.execute(sql)
+            if not has_fts(con):
+                try:
+                    con.execute(FTS_SQL["parts_fts"])
+                except sqlite3.OperationalError:
+                    # FTS5/trigram 非対応のSQLiteでは LIKE 検索のまま
+                    pass
+                else:
+                    for name, sql in FTS_SQL.items():
+                        if name != "parts_fts":
+                            con.execute(sql)
+                    con.execute("INSERT INTO parts_fts(parts_fts) VALUES ('rebuild')")
+    if not parts_mirror_fresh():
+        write_parts_mirror()
+    return merged, backup
+
+def has_index(con: sqlite3.Connection, name: str) -> bool:
+    row = con.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone()
+    return row is not None
+
+def has_fts(con: sqlite3.Connection) -> bool:
+    row = con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'parts_fts'").fetchone()
+    return row is not None
+
+# ---- Parquetミラー ----
+PARTS_PARQUET_SCHEMA = pa.schema(
+    [("id", pa.int64())]
+    + [(c, pa.float64() if c in REAL_COLS else pa.string()) for c in PARTS_MIRROR_COLS[1:]]
+)
 
-def init_db():
-    with get_conn() as con:
-        cur = con.cursor()
-        for sql in CREATE_SQL.values():
-            cur.execute(sql)
-        con.commit()
+def parts_version() -> int:
+    with locked_conn() as con:
+        (v,) = con.execute("SELECT value FROM meta WHERE key = 'parts_version'").fetchone()
+    return int(v)
+
+def write_parts_mirror():
+    # 版数とデータを同じ読み取りトランザクションで取得し、ファイルのメタデータに版数を残す
+    # 書き出し〜置き換えまで接続ロックを保持し、古い版が新しい版を上書きしないようにする
+    with locked_conn():
+        with transaction() as con:
+            ver = parts_version()
+            rows = con.execute(f"SELECT {', '.join(PARTS_MIRROR_COLS)} FROM parts ORDER BY id").fetchall()
+        cols = list(zip(*rows)) or [()] * len(PARTS_MIRROR_COLS)
+        table = pa.Table.from_arrays(
+            [pa.array(col, type=f.type) for col, f in zip(cols, PARTS_PARQUET_SCHEMA)],
+            schema=PARTS_PARQUET_SCHEMA.with_metadata({"parts_version": str(ver)}),
+        )
+        with tempfile.NamedTemporaryFile(
+            dir=PARTS_PARQUET_PATH.parent, prefix=f"{PARTS_PARQUET_PATH.name}.", suffix=".tmp", delete=False,
+        ) as f:
+            tmp = Path(f.name)
+        try:
+            pq.write_table(table, tmp)
+            os.replace(tmp, PARTS_PARQUET_PATH)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+def parts_mirror_fresh() -> bool:
+    if not PARTS_PARQUET_PATH.exists():
+        return False
+    try:
+        meta = pq.read_schema(PARTS_PARQUET_PATH).metadata or {}
+    except (OSError, pa.ArrowException):
+        return False
+    return meta.get(b"parts_version") == str(parts_version()).encode()
 
 def backup_db_file() -> Optional[Path]:
     dbp = Path(DB_PATH)
@@ -102,15 +309,33 @@ def backup_db_file() -> Optional[Path]:
     BACKUP_DIR.mkdir(parents=True, exist_ok=True)
     ts = datetime.now().strftime("%Y%m%d-%H%M%S")
     dst = BACKUP_DIR / f"{dbp.stem}.backup-{ts}{dbp.suffix}"
-    shutil.copy2(dbp, dst)
+    # WALモードでは未チェックポイントの更新が -wal 側にあるため、ファイルコピーではなくバックアップAPIを使う
+    with closing(sqlite3.connect(dst)) as bak, locked_conn() as con:
+        con.backup(bak)
     return dst
 
+def fetch_df(sql: str, params=()) -> pd.DataFrame:
+    # 小さな結果セット向け：pd.read_sql_query を通さずカーソルから直接DataFrameを作る
+    with locked_conn() as con:
+        cur = con.execute(sql, params)
+        cols = [d[0] for d in cur.description]
+        rows = cur.fetchall()
+    return pd.DataFrame(rows, columns=cols)
+
+def boms_version() -> Tuple[int, int]:
+    # list_boms のキャッシュキー用（BOMは追加のみなので件数と最大IDで変化を検出できる）
+    with locked_conn() as con:
+        n, max_id = con.execute("SELECT COUNT(*), IFNULL(MAX(id), 0) FROM boms").fetchone()
+    return int(n), int(max_id)
+
+def clear_parts_cache():
+    read_parts.clear()
+    distinct_categories.clear()
+
 def count_parts() -> int:
-    with get_conn() as con:
-        cur = con.cursor()
-        cur.execute("SELECT COUNT(*) FROM parts")
-        (n,) = cur.fetchone()
-        return int(n or 0)
+    with locked_conn() as con:
+        (n,) = con.execute("SELECT COUNT(*) FROM parts").fetchone()
+    return int(n or 0)
 
 # =========================================================
 # 起動時：マスターファイル検出/選択
@@ -123,10 +348,37 @@ def list_master_candidates() -> list[Path]:
     files.sort(key=lambda p: pri.get(p.name, 999))
     return files
 
+def _needs_c_engine(df: pd.DataFrame) -> bool:
+    # pyarrow は重複ヘッダを partNo.1 と改名せず、ISO日付/時刻風の値を date/time 型に推定する
+    if df.columns.duplicated().any():
+        return True
+    for c in df.columns:
+        s = df[c]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            return True
+        if s.dtype == object:
+            i = s.first_valid_index()
+            if i is not None and isinstance(s[i], (date, time_of_day)):
+                return True
+    return False
+
+def read_table_file(src, is_csv: bool) -> pd.DataFrame:
+    # CSVは pyarrow のマルチスレッドパーサ、xlsx は calamine（Rust製）で読む
+    if is_csv:
+        try:
+            df = pd.read_csv(src, engine="pyarrow")
+        except (pd.errors.ParserError, pa.ArrowInvalid):
+            # 列数が揃わない行などは pyarrow が拒否するので従来の C エンジンで読み直す
+            df = None
+        if df is None or _needs_c_engine(df):
+            if hasattr(src, "seek"):
+                src.seek(0)
+            df = pd.read_csv(src)
+        return df
+    return pd.read_excel(src, engine="calamine")
+
 def load_master_to_df(p: Path) -> pd.DataFrame:
-    if p.suffix.lower() == ".csv":
-        return pd.read_csv(p)
-    return pd.read_excel(p)
+    return read_table_file(p, p.suffix.lower() == ".csv")
 
 # =========================================================
 # 取り込みヘルパ
@@ -146,132 +398,206 @@ HEADER_GUESS_PATTERNS: List[Tuple[str, str]] = [
     (r"per\s*year|unitPricePerYear", "unitPricePerYear"),
 ]
 
+# 全パターンを1本の正規表現に結合（モジュール読み込み時に1回だけコンパイル）
+# 各パターンを先頭からの先読みで包み、リスト順で最初に一致したものを採用する（従来の逐次 re.search と同じ優先順位）
+# Excelのセル内改行を含む見出しもあるため、先頭の読み飛ばし部分だけ (?s:) で改行をまたぐ（各パターン内の . は従来どおり改行に一致しない）
+_GUESS_RE = re.compile("|".join(
+    f"(?=(?P<k{i}>(?s:.*?)(?:{pat})))" for i, (pat, _) in enumerate(HEADER_GUESS_PATTERNS)
+))
+_GUESS_KEYS = [key for _, key in HEADER_GUESS_PATTERNS]
+
 def guess_field(header: str) -> Optional[str]:
     h = str(header).strip().lower()
-    for pat, key in HEADER_GUESS_PATTERNS:
-        if re.search(pat, h):
-            return key
-    return None
+    m = _GUESS_RE.match(h)
+    if m is None:
+        return None
+    return _GUESS_KEYS[int(m.lastgroup[1:])]
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def parse_upload(name: str, data: bytes) -> pd.DataFrame:
+    # 中身（バイト列）がキャッシュキーになるため、マッピング変更などの再実行では再解析しない
+    return read_table_file(io.BytesIO(data), name.lower().endswith(".csv"))
+
+_SPLIT_RE = re.compile(r"\t+|\s{2,}")
 
 def parse_free_text(text: str) -> pd.DataFrame:
     lines = [l.strip() for l in text.splitlines() if l.strip()]
     rows = []
     for line in lines:
-        cols = re.split(r"\t+|\s{2,}", line)
+        cols = _SPLIT_RE.split(line)
         if len(cols) >= 2:
             part_no = cols[0]
             desc = cols[1]
-            rows.append({
-                "partNo": part_no,
-                "description": desc,
-                "manufacturer": "",
-                "category": "",
-                "unit": "set",
-                "unitPrice": None,
-                "notes": "",
-                "category1": "",
-                "category2": "",
-                "pricingModel": "fixed",
-                "unitPricePerKWh": None,
-                "unitPricePerYear": None,
-                "refCapacityKWh": None,
-            })
+            # PART_COLS の並び順のタプル（unit="set", pricingModel="fixed"、価格系は未設定）
+            rows.append((part_no, desc, "", "", "set", None, "", "", "", "fixed", None, None, None))
     return pd.DataFrame(rows, columns=PART_COLS)
 
-def insert_parts(df: pd.DataFrame) -> int:
-    if not set(PART_COLS).issubset(df.columns):
-        for c in PART_COLS:
-            if c not in df.columns:
-                df[c] = None if c not in ["manufacturer","category","unit","notes","category1","category2","pricingModel"] else ""
-    if not st.session_state.get("allow_update", False):
-        if not st.checkbox("このセッションでDB更新を許可する（確認用）"):
-            st.warning("チェックを入れるとDB更新が有効になります。")
-            return 0
-        st.session_state["allow_update"] = True
-
-    with get_conn() as con:
-        df = df.copy()
-        df["unitPrice"] = pd.to_numeric(df["unitPrice"], errors="coerce")
-        df["unitPricePerKWh"] = pd.to_numeric(df["unitPricePerKWh"], errors="coerce")
-        df["unitPricePerYear"] = pd.to_numeric(df["unitPricePerYear"], errors="coerce")
-        exist = pd.read_sql_query("SELECT partNo, description FROM parts", con)
-        if not exist.empty:
-            key_new = (df["partNo"].str.lower()+"|"+df["description"].str.lower())
-            key_exist = (exist["partNo"].str.lower()+"|"+exist["description"].str.lower()).tolist()
-            df = df[~key_new.isin(key_exist)]
-        if df.empty:
-            return 0
-        df[PART_COLS].to_sql("parts", con, if_exists="append", index=False)
-        return len(df)
-
-def read_parts(q: str = "") -> pd.DataFrame:
-    with get_conn() as con:
-        base = """
-        SELECT id, partNo, description, manufacturer, category, category1, category2,
-               unit, unitPrice, pricingModel, unitPricePerKWh, unitPricePerYear, refCapacityKWh, notes
-        FROM parts
-        """
-        if q:
-            like = f"%{q}%"
-            return pd.read_sql_query(
-                base + """ WHERE partNo LIKE ? OR description LIKE ? OR manufacturer LIKE ?
-                           OR category LIKE ? OR category1 LIKE ? OR category2 LIKE ?
-                           OR unit LIKE ? OR notes LIKE ?""",
-                con, params=[like, like, like, like, like, like, like, like],
-            )
-        return pd.read_sql_query(base, con)
+def insert_parts(df: pd.DataFrame, allow_update: bool = False) -> int:
+    # 更新可否はUI側（サイドバーのチェックボックス）で決めて渡す
+    if not allow_update:
+        return 0
+    # 列の補完は reindex 1回で行う（呼び出し元の df は変更しない）
+    missing_text = [c for c in TEXT_COLS if c not in df.columns]
+    df = df.reindex(columns=PART_COLS).assign(**{c: "" for c in missing_text})
+    df["unitPrice"] = pd.to_numeric(df["unitPrice"], errors="coerce")
+    df["unitPricePerKWh"] = pd.to_numeric(df["unitPricePerKWh"], errors="coerce")
+    df["unitPricePerYear"] = pd.to_numeric(df["unitPricePerYear"], errors="coerce")
+    if df.empty:
+        return 0
+    # NaN/NA は NULL として渡す。既存と重複する行は ux_parts_key によりスキップ
+    rows = list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+    with transaction() as con:
+        cur = con.executemany(
+            f"INSERT INTO parts({','.join(PART_COLS)}) VALUES ({','.join('?'*len(PART_COLS))})"
+            " ON CONFLICT DO NOTHING",
+            rows,
+        )
+    if cur.rowcount:
+        write_parts_mirror()
+    clear_parts_cache()
+    return cur.rowcount
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def read_parts(
+    q: str = "",
+    cat1: Tuple[str, ...] = (),
+    cat2: Tuple[str, ...] = (),
+    version: int = 0,
+) -> pd.DataFrame:
+    # version（parts_version()）はキャッシュキー専用。parts が変わったときだけ別エントリになる
+    # cat1/cat2 は OR 条件（IN）、フリーワードとは AND
+    if not q and parts_mirror_fresh():
+        # フリーワードなしの一覧はParquetミラーから読む（列・カテゴリ条件は読み込み時に適用）
+        filters = [(col, "in", list(values)) for col, values in (("category1", cat1), ("category2", cat2)) if values]
+        return pq.read_table(PARTS_PARQUET_PATH, columns=PARTS_VIEW_COLS, filters=filters or None).to_pandas()
+    base = f"SELECT {', '.join(PARTS_VIEW_COLS)} FROM parts"
+    where: List[str] = []
+    params: List[str] = []
+    with locked_conn() as con:
+        use_fts = bool(q) and len(q) >= FTS_MIN_QUERY_LEN and has_fts(con)
+    if use_fts:
+        # 全体を1つのフレーズとして渡す（trigram では部分一致になる）
+        where.append("id IN (SELECT rowid FROM parts_fts WHERE parts_fts MATCH ?)")
+        params.append('"' + q.replace('"', '""') + '"')
+    elif q:
+        # OR は左から評価して一致した時点で打ち切られるため、短い列を先に、長文の description/notes を最後に置く
+        where.append("""(partNo LIKE ? OR category1 LIKE ? OR category2 LIKE ?
+                       OR category LIKE ? OR unit LIKE ? OR manufacturer LIKE ?
+                       OR description LIKE ? OR notes LIKE ?)""")
+        params.extend([f"%{q}%"] * 8)
+    for col, values in (("category1", cat1), ("category2", cat2)):
+        if values:
+            where.append(f"{col} IN ({','.join('?'*len(values))})")
+            params.extend(values)
+    if where:
+        base += " WHERE " + " AND ".join(where)
+    with locked_conn() as con:
+        return pd.read_sql_query(base, con, params=params)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def distinct_categories(version: int = 0) -> Tuple[List[str], List[str]]:
+    # マルチセレクトの選択肢。ix_parts_cat1/cat2 を使うので全件読み込みは不要
+    with locked_conn() as con:
+        cat1 = [r[0] for r in con.execute("SELECT DISTINCT category1 FROM parts WHERE category1 <> '' ORDER BY 1")]
+        cat2 = [r[0] for r in con.execute("SELECT DISTINCT category2 FROM parts WHERE category2 <> '' ORDER BY 1")]
+    return cat1, cat2
 
 def delete_part(part_id: int):
-    with get_conn() as con:
-        con.execute("DELETE FROM parts WHERE id = ?", (part_id,))
-        con.commit()
+    with locked_conn() as con:
+        cur = con.execute("DELETE FROM parts WHERE id = ?", (part_id,))
+        if cur.rowcount:
+            write_parts_mirror()
+    clear_parts_cache()
 
 def create_bom(name: str) -> int:
-    with get_conn() as con:
-        cur = con.cursor()
-        cur.execute("INSERT INTO boms(name, createdAt) VALUES(?, ?)", (name, int(time.time()*1000)))
-        con.commit()
-        return cur.lastrowid
-
-def list_boms() -> pd.DataFrame:
-    with get_conn() as con:
-        return pd.read_sql_query("SELECT * FROM boms ORDER BY createdAt DESC", con)
-
-def list_bom_items(bom_id: int) -> pd.DataFrame:
-    with get_conn() as con:
-        sql = """
-        SELECT bi.id as itemId, bi.bomId, bi.partId, bi.qty, bi.altText,
-               p.partNo, p.description, p.manufacturer,
-               p.category, p.category1, p.category2,
-               p.unit, p.unitPrice,
-               p.pricingModel, p.unitPricePerKWh, p.unitPricePerYear, p.refCapacityKWh, p.notes
+    with locked_conn() as con:
+        cur = con.execute("INSERT INTO boms(name, createdAt) VALUES(?, ?)", (name, int(time.time()*1000)))
+    list_boms.clear()
+    return cur.lastrowid
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def list_boms(version: Tuple[int, int] = (0, 0)) -> pd.DataFrame:
+    return fetch_df("SELECT id, name, createdAt FROM boms ORDER BY createdAt DESC")
+
+def list_bom_items(bom_id: int, proj_kwh: float = 0.0, proj_years: float = 0.0, override_rate: float = 0.0) -> pd.DataFrame:
+    # 表示/出力に使う列のみ取得し、表示単価（displayUnitPrice）と金額（amount）もSQL側で計算する
+    # per_kwh は容量 > 0、per_year は年数 > 0 のときのみ。kWh単価の上書きは > 0 のときのみ
+    sql = """
+    SELECT *, ROUND(IFNULL(displayUnitPrice, 0) * IFNULL(qty, 0), 0) AS amount
+    FROM (
+        SELECT bi.id as itemId, bi.qty,
+               p.partNo, p.description, p.category1, p.category2, p.unit,
+               p.pricingModel, p.unitPrice, p.unitPricePerKWh, p.unitPricePerYear, p.notes,
+               CASE
+                   WHEN LOWER(p.pricingModel) = 'per_kwh' AND :kwh > 0
+                       THEN ROUND(COALESCE(:rate, p.unitPricePerKWh) * :kwh, 2)
+                   WHEN LOWER(p.pricingModel) = 'per_year' AND :years > 0
+                       THEN ROUND(p.unitPricePerYear * :years, 2)
+                   ELSE p.unitPrice
+               END AS displayUnitPrice
         FROM bom_items bi
         JOIN parts p ON p.id = bi.partId
-        WHERE bi.bomId = ?
-        ORDER BY bi.id ASC
-        """
-        return pd.read_sql_query(sql, con, params=[bom_id])
-
-def add_item(bom_id: int, part_id: int, qty: float = 1.0):
-    with get_conn() as con:
-        con.execute("INSERT INTO bom_items(bomId, partId, qty) VALUES(?, ?, ?)", (bom_id, part_id, qty))
-        con.commit()
+        WHERE bi.bomId = :bom_id
+    )
+    ORDER BY itemId ASC
+    """
+    params = {
+        "bom_id": bom_id,
+        "kwh": proj_kwh,
+        "years": proj_years,
+        "rate": override_rate if override_rate > 0 else None,
+    }
+    return fetch_df(sql, params)
+
+def add_items(bom_id: int, part_ids: List[int], qty: float = 1.0):
+    with transaction() as con:
+        con.executemany(
+            "INSERT INTO bom_items(bomId, partId, qty) VALUES(?, ?, ?)",
+            [(bom_id, int(pid), qty) for pid in part_ids],
+        )
 
 def remove_item(item_id: int):
-    with get_conn() as con:
+    with locked_conn() as con:
         con.execute("DELETE FROM bom_items WHERE id = ?", (item_id,))
-        con.commit()
 
 def update_qty(item_id: int, qty: float):
-    with get_conn() as con:
+    with locked_conn() as con:
         con.execute("UPDATE bom_items SET qty = ? WHERE id = ?", (qty, item_id))
-        con.commit()
+
+# =========================================================
+# 出力ヘルパ
+# =========================================================
+def bom_to_csv(export_df: pd.DataFrame) -> bytes:
+    # Arrowのバッファから直接UTF-8で書き出す（Excelで開けるようBOM付き）
+    buf = pa.BufferOutputStream()
+    pa_csv.write_csv(pa.Table.from_pandas(export_df, preserve_index=False), buf)
+    return b"\xef\xbb\xbf" + buf.getvalue().to_pybytes()
+
+def bom_to_xlsx(export_df: pd.DataFrame, total: int) -> bytes:
+    # constant_memory モードは行単位で一時ファイルへ書き出すため、上の行から順に write_row する
+    bio = io.BytesIO()
+    wb = xlsxwriter.Workbook(bio, {"constant_memory": True})
+    ws = wb.add_worksheet("BOM")
+    ws.write_row(0, 0, list(export_df.columns))
+    values = export_df.astype(object).where(export_df.notna(), None)
+    for r, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        ws.write_row(r, 0, row)
+    ws.write_row(len(export_df) + 2, 0, ["", "", "", "", "", "合計", "", total, ""])
+    wb.close()
+    return bio.getvalue()
 
 # =========================================================
 # Streamlit App
 # =========================================================
 st.set_page_config(page_title="BOM Builder", page_icon="🧩", layout="wide")
-init_db()
+merged_parts, merge_backup = init_db()
+# init_db の結果はプロセス全体でキャッシュされるので、各セッションで1回だけ知らせる
+if merged_parts and not st.session_state.get("merge_notice_shown"):
+    st.session_state["merge_notice_shown"] = True
+    st.warning(
+        f"重複していたパーツ {merged_parts} 件を統合しました（BOM明細は残したパーツへ付け替え済み）。"
+        f"統合前のバックアップ: {merge_backup}"
+    )
 
 # ---- サイドバー：起動時の読み込み（手動選択対応） ----
 st.sidebar.header("起動時の読み込み")
@@ -303,7 +629,11 @@ if up is not None:
 elif selected_path is not None and selected_path.exists():
     load_src = selected_path
 
-if st.sidebar.button("このマスターファイルを読み込む", use_container_width=True, type="primary", disabled=(load_src is None)):
+allow_update = st.sidebar.checkbox("このセッションでDB更新を許可する（確認用）", key="allow_update")
+if not allow_update:
+    st.sidebar.caption("チェックを入れるとDB更新（マスター読み込み・パーツ追加・取り込み確定）が有効になります。")
+
+if st.sidebar.button("このマスターファイルを読み込む", use_container_width=True, type="primary", disabled=(load_src is None or not allow_update)):
     try:
         dfm = load_master_to_df(load_src)
         all_cols = list(dfm.columns)
@@ -322,7 +652,7 @@ if st.sidebar.button("このマスターファイルを読み込む", use_contai
         df_norm["unit"] = df_norm["unit"].replace("", "set")
         df_norm["pricingModel"] = df_norm["pricingModel"].replace("", "fixed")
         backup_db_file()
-        n = insert_parts(df_norm)
+        n = insert_parts(df_norm, allow_update=allow_update)
         st.sidebar.success(f"{load_src.name} から {n} 件を取り込みました")
     except Exception as e:
         st.sidebar.error(f"読み込み失敗: {e}")
@@ -348,16 +678,10 @@ TAB_DB, TAB_INGEST, TAB_BOM = st.tabs(["データベース", "資料取り込み
 with TAB_DB:
     st.subheader("検索・一覧")
     q = st.text_input("フリーワード（品番・品名・カテゴリ1/2・備考…）", value="")
-    df_all = read_parts(q)
-
-    # 欠損処理
-    for c in ["category1","category2","pricingModel","unit"]:
-        if c in df_all.columns:
-            df_all[c] = df_all[c].fillna("")
-
+    if len(q) < SEARCH_MIN_QUERY_LEN:
+        q = ""
     # マルチセレクト（OR条件）
-    cat1_options = sorted([c for c in df_all["category1"].unique().tolist() if c])
-    cat2_options = sorted([c for c in df_all["category2"].unique().tolist() if c])
+    cat1_options, cat2_options = distinct_categories(parts_version())
 
     c1, c2 = st.columns(2)
     with c1:
@@ -365,11 +689,13 @@ with TAB_DB:
     with c2:
         sel_c2 = st.multiselect("カテゴリ2で絞り込み（複数可）", options=cat2_options, default=[])
 
-    df_view = df_all.copy()
-    if sel_c1:
-        df_view = df_view[df_view["category1"].isin(sel_c1)]
-    if sel_c2:
-        df_view = df_view[df_view["category2"].isin(sel_c2)]
+    # カテゴリ絞り込みはSQL側で行う（ix_parts_cat1/cat2）
+    df_view = read_parts(q, tuple(sel_c1), tuple(sel_c2), parts_version())
+
+    # 欠損処理
+    for c in ["category1","category2","pricingModel","unit"]:
+        if c in df_view.columns:
+            df_view[c] = df_view[c].fillna("")
 
     # チェックボックスで選択
     if "_select" not in df_view.columns:
@@ -377,8 +703,7 @@ with TAB_DB:
 
     st.caption("BOMに追加したい行にチェックを入れてください。")
     edited = st.data_editor(
-        df_view[["_select","id","partNo","description","category1","category2",
-                 "pricingModel","unit","unitPrice","unitPricePerKWh","unitPricePerYear","notes"]],
+        df_view[["_select"] + PARTS_VIEW_COLS],
         use_container_width=True, height=450, hide_index=True
     )
     selected_ids = edited.loc[edited["_select"] == True, "id"].astype(int).tolist()
@@ -402,7 +727,7 @@ with TAB_DB:
             unitPricePerKWh = st.number_input("単価 (/kWh)", min_value=0.0, step=0.01, value=0.0, format="%.4f")
             unitPricePerYear = st.number_input("単価 (/year)", min_value=0.0, step=100.0, value=0.0, format="%.2f")
             notes = st.text_area("備考", height=80)
-        if st.form_submit_button("保存"):
+        if st.form_submit_button("保存", disabled=not allow_update):
             if not partNo.strip():
                 st.warning("品番は必須です")
             else:
@@ -422,7 +747,7 @@ with TAB_DB:
                     "unitPricePerYear": float(unitPricePerYear) if unitPricePerYear else None,
                     "refCapacityKWh": None,
                 }])[PART_COLS]
-                n = insert_parts(row)
+                n = insert_parts(row, allow_update=allow_update)
                 st.success(f"{n} 件を追加しました")
                 st.experimental_rerun()
 
@@ -448,11 +773,13 @@ with TAB_INGEST:
         st.session_state["pending_import"] = None
 
     up = st.file_uploader("CSV または Excel(xlsx) を選択", type=["csv","xlsx"])
+    df_raw = None
     if up is not None:
-        if up.type == "text/csv" or up.name.lower().endswith(".csv"):
-            df_raw = pd.read_csv(up)
-        else:
-            df_raw = pd.read_excel(up)
+        try:
+            df_raw = parse_upload(up.name, up.getvalue())
+        except Exception as e:
+            st.error(f"ファイルを読み込めませんでした: {e}")
+    if df_raw is not None:
         st.write("プレビュー（先頭20行）")
         st.dataframe(df_raw.head(20), use_container_width=True, height=300)
 
@@ -500,10 +827,10 @@ with TAB_INGEST:
                 st.session_state["pending_import"] = None
                 st.info("取り込み候補を破棄しました。")
         with col_c2:
-            if st.button("✅ 確定してDB更新", disabled=not confirm):
+            if st.button("✅ 確定してDB更新", disabled=not (confirm and allow_update)):
                 try:
                     backup_db_file()
-                    n = insert_parts(dfp)
+                    n = insert_parts(dfp, allow_update=allow_update)
                     st.success(f"{n} 件をDBに反映しました")
                     st.session_state["pending_import"] = None
                 except Exception as e:
@@ -528,7 +855,7 @@ with TAB_BOM:
                 st.success(f"BOMを作成しました (id={new_id})")
                 st.experimental_rerun()
 
-    df_boms = list_boms()
+    df_boms = list_boms(boms_version())
     st.dataframe(df_boms, use_container_width=True, height=180)
 
     target_bom_id = st.number_input("操作対象のBOM ID", min_value=0, step=1, value=int(df_boms.iloc[0]["id"]) if not df_boms.empty else 0)
@@ -543,8 +870,7 @@ with TAB_BOM:
         elif target_bom_id <= 0:
             st.warning("BOM ID を入力してください。")
         else:
-            for pid in sel_ids:
-                add_item(int(target_bom_id), int(pid), qty=1.0)
+            add_items(int(target_bom_id), sel_ids, qty=1.0)
             st.success(f"{len(sel_ids)} 件をBOM({target_bom_id})へ追加しました。")
 
     st.markdown("---")
@@ -560,25 +886,9 @@ with TAB_BOM:
         override_rate = st.number_input("EMS等のkWh単価を一時上書き（任意）", min_value=0.0, step=0.01, value=0.0, help="0 のままならDB値を使用")
 
     if target_bom_id > 0:
-        df_items = list_bom_items(int(target_bom_id))
-        if not df_items.empty:
-            df = df_items.copy()
-
-            # 表示用の単価（displayUnitPrice）を計算
-            df["displayUnitPrice"] = df["unitPrice"]
-            # per_kwh
-            if "unitPricePerKWh" in df.columns:
-                per_mask = df["pricingModel"].astype(str).str.lower().eq("per_kwh") & (proj_kwh > 0)
-                base_rate = df["unitPricePerKWh"]
-                if override_rate > 0:
-                    base_rate = override_rate
-                df.loc[per_mask, "displayUnitPrice"] = (base_rate * proj_kwh).round(2)
-            # per_year
-            if "unitPricePerYear" in df.columns:
-                py_mask = df["pricingModel"].astype(str).str.lower().eq("per_year") & (proj_years > 0)
-                df.loc[py_mask, "displayUnitPrice"] = (df.loc[py_mask, "unitPricePerYear"] * proj_years).round(2)
-
-            df["amount"] = (df["displayUnitPrice"].fillna(0) * df["qty"].fillna(0)).round(0)
+        # 表示単価・金額は list_bom_items 側で計算済み
+        df = list_bom_items(int(target_bom_id), proj_kwh, proj_years, override_rate)
+        if not df.empty:
             total = int(df["amount"].sum())
 
             st.dataframe(df, use_container_width=True, height=380)
@@ -611,19 +921,13 @@ with TAB_BOM:
             export_df = df[out_cols].rename(columns={"displayUnitPrice":"unitPrice"})
             st.download_button(
                 label="BOMをCSVでダウンロード",
-                data=export_df.to_csv(index=False).encode("utf-8-sig"),
+                data=bom_to_csv(export_df),
                 file_name=f"bom_{int(target_bom_id)}.csv",
                 mime="text/csv",
             )
-            bio = io.BytesIO()
-            with pd.ExcelWriter(bio, engine="openpyxl") as writer:
-                export_df.to_excel(writer, index=False, sheet_name="BOM")
-                pd.DataFrame([["","","","","","合計", "", total, ""]],
-                             columns=["partNo","description","category1","category2","unit","unitPrice","qty","amount","notes"]
-                            ).to_excel(writer, index=False, startrow=len(export_df)+2, sheet_name="BOM", header=False)
             st.download_button(
                 label="BOMをExcelでダウンロード",
-                data=bio.getvalue(),
+                data=bom_to_xlsx(export_df, total),
                 file_name=f"bom_{int(target_bom_id)}.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )